@@ -1,25 +1,69 @@
+import asyncio
 import logging
-import time
+import os
+import re
 import datetime
-from fastapi import FastAPI, Form, Response
+import enum
+from xml.sax.saxutils import escape as xml_escape
+from cachetools import TTLCache
+from fastapi import Depends, FastAPI, Form, Response
 from fastapi.responses import JSONResponse
-from twilio.twiml.messaging_response import MessagingResponse
-from sqlalchemy import create_engine, Column, String, Integer, Date, Text, ForeignKey
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy import Column, Enum as SAEnum, String, Integer, Date, Text, ForeignKey, Index, bindparam, event, insert, or_, select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base, make_transient_to_detached, relationship
+from sqlalchemy.orm.attributes import set_committed_value
 
 # --- Logging Setup ---
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+# LOG_LEVEL=DEBUG also turns on per-request timing (see log_timing)
+logging.basicConfig(level=(os.getenv("LOG_LEVEL") or "INFO").upper(), format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-# --- Database Setup (SQLite) ---
-import os
+# --- Database Setup (async: aiosqlite / asyncpg) ---
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./accountability.db")
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(bind=engine)
+# Sized for webhook bursts; give up after 10s instead of the default 30s wait
+POOL_OPTS = {"pool_size": 20, "max_overflow": 40, "pool_timeout": 10}
+if DATABASE_URL.startswith("sqlite://"):
+    DATABASE_URL = DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    engine = create_async_engine(DATABASE_URL, connect_args={"check_same_thread": False}, **POOL_OPTS)
+
+    # Pooled connections run these once, not per request
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _):
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA cache_size=-64000")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA mmap_size=268435456")
+        cur.close()
+else:
+    # Heroku/Fly hand out "postgres://" URLs; asyncpg needs an explicit driver
+    url = make_url(DATABASE_URL).set(drivername="postgresql+asyncpg")
+    # asyncpg rejects libpq's sslmode query arg; it takes the same modes as ssl=
+    connect_args = {}
+    if "sslmode" in url.query:
+        connect_args["ssl"] = url.query["sslmode"]
+        url = url.difference_update_query(["sslmode"])
+    engine = create_async_engine(
+        url, connect_args=connect_args, pool_recycle=1800, pool_pre_ping=True, **POOL_OPTS
+    )
+async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 Base = declarative_base()
 
+def today_utc():
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+# --- Conversation States ---
+class UserState(enum.Enum):
+    awaiting_name = "awaiting_name"
+    awaiting_goal = "awaiting_goal"
+    idle = "idle"
+
 # --- User Table ---
 class User(Base):
     __tablename__ = "users"
@@ -29,21 +73,250 @@ class User(Base):
     points = Column(Integer, default=100)
     streak = Column(Integer, default=0)
     last_update = Column(Date, nullable=True)
-    state = Column(String, default="idle")  # new, awaiting_name, awaiting_goal, idle
+    # Non-native so existing VARCHAR state columns keep working unmigrated
+    state = Column(SAEnum(UserState, name="user_state", native_enum=False), default=UserState.idle)
 
-    progress_entries = relationship("Progress", back_populates="user")
+    progress_entries = relationship("Progress", back_populates="user", lazy="raise")
+
+    __table_args__ = (
+        Index("ix_users_points_desc", points.desc()),  # leaderboard
+    )
 
 # --- Progress Table ---
 class Progress(Base):
     __tablename__ = "progress"
     id = Column(Integer, primary_key=True, index=True)
     phone = Column(String, ForeignKey("users.phone"))
-    date = Column(Date, default=datetime.date.today)
+    date = Column(Date, default=today_utc)
     entry_text = Column(Text)
 
-    user = relationship("User", back_populates="progress_entries")
+    user = relationship("User", back_populates="progress_entries", lazy="raise")
+
+    __table_args__ = (
+        Index("ix_progress_phone_date", "phone", "date"),  # history, summary
+    )
+
+def _create_schema(sync_conn):
+    Base.metadata.create_all(sync_conn)
+    # create_all skips tables that already exist, and with them any indexes
+    # added to the models later; create those individually
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(_create_schema)
+    await engine.dispose()
+
+async def get_session():
+    async with async_session() as db:
+        yield db
+
+# --- Prebuilt Statements ---
+# Built once at import; each request only binds parameters
+TOP10 = select(User.phone, User.points, User.streak).order_by(User.points.desc()).limit(10)
+HISTORY = (
+    select(Progress.date, Progress.entry_text)
+    .where(Progress.phone == bindparam("phone"))
+    .order_by(Progress.date.desc()).limit(7)
+)
+# One row per day with a check-in, so duplicate entries count once
+CHECKIN_DAYS = (
+    select(Progress.date)
+    .where(Progress.phone == bindparam("phone"), Progress.date >= bindparam("since"))
+    .group_by(Progress.date).order_by(Progress.date)
+)
+
+# --- Caches ---
+# Users are cached as plain column snapshots so a cached row is never shared
+# between two live sessions; the leaderboard as (phone, points, streak) tuples.
+USER_CACHE = TTLCache(maxsize=10_000, ttl=30)
+LEADERBOARD_CACHE = TTLCache(maxsize=1, ttl=60)
+
+def cache_user(user):
+    # Only idle users are cached: onboarding branches on state, and a stale
+    # snapshot on another process would replay an earlier step
+    if user.state is not UserState.idle:
+        USER_CACHE.pop(user.phone, None)
+        return
+    USER_CACHE[user.phone] = {c.key: getattr(user, c.key) for c in User.__table__.columns}
+
+async def get_user(db, phone):
+    cached = USER_CACHE.get(phone)
+    if cached is not None:
+        # Re-attach the snapshot as an already-loaded row: no SELECT is issued
+        user = User(**cached)
+        make_transient_to_detached(user)
+        db.add(user)
+        return user
+    user = await db.get(User, phone)
+    if user:
+        cache_user(user)
+    return user
+
+# --- Replies ---
+WELCOME_TEXT = (
+    "👋 Welcome friend! I'm GAP - your goal accountability partner.\n\n"
+    "What's your name?"
+)
+UNKNOWN_TEXT = "🤔 I didn't get that. Try asking for 'help'."
+HELP_TEXT = (
+    "📝 Commands:\n"
+    "✅ goal - set your goal\n"
+    "📈 progress - log today's progress\n"
+    "📊 status - view your stats\n"
+    "🗒 history - last 7 updates\n"
+    "📅 summary - weekly summary\n"
+    "🏆 leaderboard - see active users\n"
+    "💰 withdraw - request cash\n"
+    "🤔 help - show this menu"
+)
+
+# A single-message TwiML reply has a fixed shape, so it is formatted directly
+# rather than built and serialised as an ElementTree by MessagingResponse.
+# Returned as bytes so Response sends it without encoding it again.
+def _twiml(body):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f"<Response><Message><Body>{xml_escape(body)}</Body></Message></Response>"
+    ).encode("utf-8")
+
+# TwiML for replies that never change is rendered once, at import
+STATIC_XML = {body: _twiml(body) for body in (WELCOME_TEXT, UNKNOWN_TEXT, HELP_TEXT)}
+
+def render(reply_text):
+    xml = STATIC_XML.get(reply_text)
+    if xml is None:
+        xml = _twiml(reply_text)
+    return Response(content=xml, media_type="application/xml")
 
-Base.metadata.create_all(bind=engine)
+# --- Command Handlers ---
+# Each handler takes (db, user, arg, today), where arg is the text after the
+# command word and today is the request's UTC date, and returns the reply text.
+async def _handle_hello(db, user, arg, today):
+    return (
+        f"👋 Hey {user.name or 'friend'}, welcome back!\n"
+        "Type 'progress' to log today's progress or 'help' to see commands."
+    )
+
+async def _handle_goal(db, user, arg, today):
+    if not arg:
+        return "Please enter a goal, e.g., 'goal read a book'"
+    user.goal = arg
+    await db.commit()
+    cache_user(user)
+    return f"✅ Goal saved: {arg}"
+
+async def _handle_progress(db, user, arg, today):
+    entry_text = arg or "No progress shared!"
+    already_done = "📊 You've already reported progress today. See you tomorrow!"
+    if user.last_update == today:
+        return already_done
+    # The once-a-day check and the increment are one server-side statement, so
+    # concurrent webhooks can neither lose an update nor log the same day twice
+    row = (await db.execute(
+        update(User)
+        .where(User.phone == user.phone, or_(User.last_update.is_(None), User.last_update != today))
+        .values(streak=User.streak + 1, points=User.points + 100, last_update=today)
+        .returning(User.streak, User.points)
+        .execution_options(synchronize_session=False)
+    )).one_or_none()
+    if row is None:
+        # Another request logged today first; our snapshot predates its
+        # increment, so drop it and let the next request reload the row
+        USER_CACHE.pop(user.phone, None)
+        return already_done
+    streak, points = row
+    await db.execute(insert(Progress).values(phone=user.phone, date=today, entry_text=entry_text))
+    await db.commit()
+    for key, value in (("streak", streak), ("points", points), ("last_update", today)):
+        set_committed_value(user, key, value)
+    cache_user(user)
+    LEADERBOARD_CACHE.clear()
+    return (
+        f"📈 Progress logged! 🎉\n"
+        f"Streak: {streak} days\n"
+        f"Points: {points}"
+    )
+
+async def _handle_status(db, user, arg, today):
+    return (
+        f"📊 Your Status, {user.name}:\n"
+        f"Goal: {user.goal or 'Not set'}\n"
+        f"Streak: {user.streak} days\n"
+        f"Points: {user.points}"
+    )
+
+async def _handle_history(db, user, arg, today):
+    entries = (await db.execute(HISTORY, {"phone": user.phone})).all()
+    if not entries:
+        return "🗒 No history yet. Log progress with 'progress'."
+    history_text = "\n".join([f"{e.date}: {e.entry_text}" for e in entries])
+    return f"🗒 Last 7 updates:\n{history_text}"
+
+async def _handle_summary(db, user, arg, today):
+    last_7_days = today - datetime.timedelta(days=6)
+    days = (await db.execute(CHECKIN_DAYS, {"phone": user.phone, "since": last_7_days})).scalars().all()
+    total_days = 7
+    checkins = len(days)
+    percent = round((checkins / total_days) * 100, 1)
+    if not days:
+        return "📅 No progress in the last 7 days."
+    summary_text = "\n".join([f"{day}: ✅" for day in days])
+    return (
+        f"📅 Weekly Summary for {user.name}:\n"
+        f"{summary_text}\n\n"
+        f"Check-ins: {checkins}/{total_days} ({percent}%)\n"
+        f"Streak: {user.streak} days\n"
+        f"Points: {user.points}"
+    )
+
+async def _handle_leaderboard(db, user, arg, today):
+    top_users = LEADERBOARD_CACHE.get("top10")
+    if top_users is None:
+        top_users = LEADERBOARD_CACHE["top10"] = [tuple(row) for row in (await db.execute(TOP10)).all()]
+    if not top_users:
+        return "🏆 No leaderboard data yet."
+    leaderboard_text = "\n".join(
+        [f"{i+1}. {phone[-4:]} | {points} pts | {streak}🔥" for i, (phone, points, streak) in enumerate(top_users)]
+    )
+    return f"🏆 Leaderboard (Top 10):\n{leaderboard_text}"
+
+async def _handle_withdraw(db, user, arg, today):
+    if user.streak >= 30:
+        return "💰 You're eligible for withdrawal! We'll process your points for cash."
+    return f"🚫 Not yet! You need a 30-day streak. Current streak: {user.streak}"
+
+async def _handle_help(db, user, arg, today):
+    return HELP_TEXT
+
+HANDLERS = {
+    "hello": _handle_hello,
+    "goal": _handle_goal,
+    "progress": _handle_progress,
+    "status": _handle_status,
+    "history": _handle_history,
+    "summary": _handle_summary,
+    "leaderboard": _handle_leaderboard,
+    "withdraw": _handle_withdraw,
+    "help": _handle_help,
+}
+# Commands are matched once, as the first word of the message
+COMMAND_RE = re.compile(r"^\s*(?P<cmd>" + "|".join(HANDLERS) + r")\b", re.I)
+
+# --- Request timing ---
+# Only installed at DEBUG: HTTP middleware wraps every request in its own
+# task and stream, which would double the cost of a cheap route for no output
+async def log_timing(request, call_next):
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    response = await call_next(request)
+    logger.debug("%s processed in %.2f ms", request.url.path, (loop.time() - start) * 1000)
+    return response
+
+if logger.isEnabledFor(logging.DEBUG):
+    app.middleware("http")(log_timing)
 
 # --- Health check route ---
 @app.get("/ping")
@@ -53,166 +326,69 @@ async def ping():
 
 # --- WhatsApp Webhook ---
 @app.post("/whatsapp")
-async def whatsapp_reply(From: str = Form(...), Body: str = Form(...)):
-    start_time = time.time()
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.phone == From).first()
-        logger.info(f"Incoming message from {From}: {Body}")
-
-        resp = MessagingResponse()
-        msg = resp.message()
-        text = Body.strip()
-        lower_text = text.lower()
-
-        # --- New User Registration ---
-        if not user:
-            user = User(phone=From, points=100, streak=0, state="awaiting_name")
-            db.add(user)
-            db.commit()
-            reply_text = (
-                "👋 Welcome friend! I'm GAP - your goal accountability partner.\n\n"
-                "What's your name?"
-            )
-            msg.body(reply_text)
-            logger.info(f"Reply to {From}: {reply_text}")
-            return Response(content=str(resp), media_type="application/xml")
-
-        # --- Awaiting Name ---
-        if user.state == "awaiting_name":
-            user.name = text
-            user.state = "awaiting_goal"
-            db.commit()
-            reply_text = (
-                f"Nice to meet you, {user.name}! 🎉\n\n"
-                "What's the main goal you'd love to work on today?"
-            )
-            msg.body(reply_text)
-            logger.info(f"Reply to {From}: {reply_text}")
-            return Response(content=str(resp), media_type="application/xml")
-
-        # --- Awaiting Goal ---
-        if user.state == "awaiting_goal":
-            user.goal = text
-            user.state = "idle"
-            db.commit()
-            reply_text = (
-                f"✅ Got it, {user.name}! Your goal is: \n{user.goal}.\n\n"
-                "You can log your progress by typing 'progress'.\n"
-                "Type 'help' to see all commands."
-            )
-            msg.body(reply_text)
-            logger.info(f"Reply to {From}: {reply_text}")
-            return Response(content=str(resp), media_type="application/xml")
-
-        # --- Commands ---
-        reply_text = "🤔 I didn't get that. Try asking for 'help'."
-
-        if "hello" in lower_text:
-            reply_text = (
-                f"👋 Hey {user.name or 'friend'}, welcome back!\n"
-                "Type 'progress' to log today's progress or 'help' to see commands."
-            )
-
-        elif lower_text.startswith("goal"):
-            goal_text = Body[5:].strip()
-            if goal_text:
-                user.goal = goal_text
-                db.commit()
-                reply_text = f"✅ Goal saved: {goal_text}"
-            else:
-                reply_text = "Please enter a goal, e.g., 'goal read a book'"
-
-        elif lower_text.startswith("progress"):
-            today = datetime.date.today()
-            entry_text = Body[9:].strip() or "No progress shared!"
-            if user.last_update == today:
-                reply_text = "📊 You've already reported progress today. See you tomorrow!"
-            else:
-                user.streak += 1
-                user.points += 100
-                user.last_update = today
-                new_entry = Progress(phone=user.phone, date=today, entry_text=entry_text)
-                db.add(new_entry)
-                db.commit()
-                reply_text = (
-                    f"📈 Progress logged! 🎉\n"
-                    f"Streak: {user.streak} days\n"
-                    f"Points: {user.points}"
-                )
-
-        elif "status" in lower_text:
-            reply_text = (
-                f"📊 Your Status, {user.name}:\n"
-                f"Goal: {user.goal or 'Not set'}\n"
-                f"Streak: {user.streak} days\n"
-                f"Points: {user.points}"
-            )
-
-        elif "history" in lower_text:
-            entries = db.query(Progress).filter(Progress.phone == user.phone).order_by(Progress.date.desc()).limit(7).all()
-            if not entries:
-                reply_text = "🗒 No history yet. Log progress with 'progress'."
-            else:
-                history_text = "\n".join([f"{e.date}: {e.entry_text}" for e in entries])
-                reply_text = f"🗒 Last 7 updates:\n{history_text}"
-
-        elif "summary" in lower_text:
-            today = datetime.date.today()
-            last_7_days = today - datetime.timedelta(days=6)
-            entries = db.query(Progress).filter(
-                Progress.phone == user.phone,
-                Progress.date >= last_7_days
-            ).order_by(Progress.date).all()
-            total_days = 7
-            checkins = len(entries)
-            percent = round((checkins / total_days) * 100, 1)
-            if not entries:
-                reply_text = "📅 No progress in the last 7 days."
-            else:
-                summary_text = "\n".join([f"{e.date}: ✅" for e in entries])
-                reply_text = (
-                    f"📅 Weekly Summary for {user.name}:\n"
-                    f"{summary_text}\n\n"
-                    f"Check-ins: {checkins}/{total_days} ({percent}%)\n"
-                    f"Streak: {user.streak} days\n"
-                    f"Points: {user.points}"
-                )
-
-        elif "leaderboard" in lower_text:
-            top_users = db.query(User).order_by(User.points.desc()).limit(10).all()
-            if not top_users:
-                reply_text = "🏆 No leaderboard data yet."
-            else:
-                leaderboard_text = "\n".join(
-                    [f"{i+1}. {u.phone[-4:]} | {u.points} pts | {u.streak}🔥" for i, u in enumerate(top_users)]
-                )
-                reply_text = f"🏆 Leaderboard (Top 10):\n{leaderboard_text}"
-
-        elif "withdraw" in lower_text:
-            if user.streak >= 30:
-                reply_text = "💰 You're eligible for withdrawal! We'll process your points for cash."
-            else:
-                reply_text = f"🚫 Not yet! You need a 30-day streak. Current streak: {user.streak}"
-
-        elif "help" in lower_text:
-            reply_text = (
-                "📝 Commands:\n"
-                "✅ goal - set your goal\n"
-                "📈 progress - log today's progress\n"
-                "📊 status - view your stats\n"
-                "🗒 history - last 7 updates\n"
-                "📅 summary - weekly summary\n"
-                "🏆 leaderboard - see active users\n"
-                "💰 withdraw - request cash\n"
-                "🤔 help - show this menu"
-            )
-
-        msg.body(reply_text)
-        logger.info(f"Reply to {From}: {reply_text}")
-        return Response(content=str(resp), media_type="application/xml")
-
-    finally:
-        db.close()
-        duration = round((time.time() - start_time) * 1000, 2)
-        logger.info(f"Request from {From} processed in {duration} ms")
+async def whatsapp_reply(From: str = Form(...), Body: str = Form(...), db: AsyncSession = Depends(get_session)):
+    user = await get_user(db, From)
+    logger.info("Incoming message from %s: %s", From, Body)
+
+    text = Body.strip()
+    today = today_utc()
+
+    # --- New User Registration ---
+    if not user:
+        # ON CONFLICT DO NOTHING: a duplicate first message racing this one
+        # (e.g. a Twilio retry) just gets the welcome again, not an IntegrityError
+        dialect_insert = sqlite_insert if engine.dialect.name == "sqlite" else pg_insert
+        user = (await db.execute(
+            dialect_insert(User)
+            .values(phone=From, points=100, streak=0, state=UserState.awaiting_name)
+            .on_conflict_do_nothing(index_elements=["phone"])
+            .returning(User)
+        )).scalar_one_or_none()
+        await db.commit()
+        if user:
+            cache_user(user)
+            LEADERBOARD_CACHE.clear()
+        reply_text = WELCOME_TEXT
+        logger.info("Reply to %s: %s", From, reply_text)
+        return render(reply_text)
+
+    # --- Awaiting Name ---
+    if user.state is UserState.awaiting_name:
+        user.name = text
+        user.state = UserState.awaiting_goal
+        await db.commit()
+        cache_user(user)
+        reply_text = (
+            f"Nice to meet you, {user.name}! 🎉\n\n"
+            "What's the main goal you'd love to work on today?"
+        )
+        logger.info("Reply to %s: %s", From, reply_text)
+        return render(reply_text)
+
+    # --- Awaiting Goal ---
+    if user.state is UserState.awaiting_goal:
+        user.goal = text
+        user.state = UserState.idle
+        await db.commit()
+        cache_user(user)
+        reply_text = (
+            f"✅ Got it, {user.name}! Your goal is: \n{user.goal}.\n\n"
+            "You can log your progress by typing 'progress'.\n"
+            "Type 'help' to see all commands."
+        )
+        logger.info("Reply to %s: %s", From, reply_text)
+        return render(reply_text)
+
+    # --- Commands ---
+    m = COMMAND_RE.match(text)
+    if m:
+        reply_text = await HANDLERS[m.group("cmd").lower()](db, user, text[m.end():].strip(), today)
+    else:
+        reply_text = UNKNOWN_TEXT
+
+    logger.info("Reply to %s: %s", From, reply_text)
+    return render(reply_text)
+
+# --- Schema setup: `python whatsapp_bot.py` (Procfile release phase, Docker CMD) ---
+if __name__ == "__main__":
+    asyncio.run(init_db())